@@ -1,7 +1,8 @@
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from CW_preprocessing import DataBaseManager as dbm
+from CW_preprocessing import db_version, get_manager
 """
 This program fetches, processes, and visualizes data related to an artist's music genre popularity
 and compares it with overall genre popularity. The artist's popularity is retrieved from an SQLite 
@@ -23,21 +24,62 @@ Usage:
     displayed one after the other.
 """
 
+# Applies the graph style once on import rather than on every plot
+plt.style.use("seaborn-v0_8-colorblind")
+
+# Figure shared by Visualise objects that opt in to reusing it
+_FIG = None
+
+
+def get_figure(figsize, reuse=False):
+    """
+    Returns a figure with a single axes. A new figure is created unless reuse
+    is requested, in which case the figure from the previous reusing call is
+    cleared and drawn on again while it is still open.
+
+    Args:
+        figsize (tuple): Size of the figure (width, height).
+        reuse (bool, optional): Whether to reuse the shared figure. Only safe
+            when each plot is shown and finished with before the next, e.g. a
+            blocking 'plt.show()'. Defaults to False.
+
+    Returns:
+        tuple: The Matplotlib figure and its axes.
+    """
+    global _FIG
+    if not reuse:
+        fig = plt.figure(figsize=figsize)
+        return fig, fig.add_subplot(111)
+
+    # A figure closed by the user or the backend cannot be shown again
+    if _FIG is None or not plt.fignum_exists(_FIG.number):
+        _FIG = plt.figure(figsize=figsize)
+    else:
+        plt.figure(_FIG.number)
+        _FIG.clear()
+        _FIG.set_size_inches(*figsize)
+
+    return _FIG, _FIG.add_subplot(111)
+
 
 class Visualise:
     """
     A class for creating visualisations.
     """
 
-    def __init__(self, data):
+    def __init__(self, data, reuse_figure=False):
         """
         Initialises the Visualise class with a dataset
 
         Parameters:
             data (Pandas.DataFrame): Data frame to be visualised into the selected
                 figure.
+            reuse_figure (bool, optional): Whether plots clear and reuse one
+                shared figure instead of creating a new one each time. See
+                'get_figure'. Defaults to False.
         """
         self.data = data
+        self.reuse_figure = reuse_figure
 
     def create_table(self,
                      title=None,
@@ -46,7 +88,8 @@ class Visualise:
                      col_color=None,
                      row_color=None,
                      fill_na="NA",
-                     figsize=(14, 6)):
+                     figsize=(14, 6),
+                     fontsize=None):
         """
         Creates and displays a table with the selected data with customisable
         formatting and styling.
@@ -59,9 +102,11 @@ class Visualise:
             conditions (list[dict], optional): A list of dictionaries to specify the 
                 cell formatting conditions. Each dictionary must include:    
                     - 'columns' (list[int]): Indices of columns to apply the conditions.
-                    - 'condition_func' (callable): Function that defines the condition.
-                        Should return a boolean value.
-                        Example: 'lambda x: x > 10'
+                    - 'condition' (callable): Function that defines the condition.
+                        It is called once per column with the column's values
+                        followed by every column's values as NumPy arrays, and
+                        should return a boolean array (or a single boolean).
+                        Example: 'lambda x, *row: x > row[2]'
                     - 'color' (str): Color to change the cells if the condition is met.
                 Defaults to None.
             col_color (list[dict], optional): Dictionary containing the column name 
@@ -74,6 +119,9 @@ class Visualise:
                 Defaults to NA.
             figsize (tuple, optional): Size of the figure (width, height). 
                 Defaults to (14, 6)
+            fontsize (float, optional): Fixed font size for the table text. Skips
+                measuring every cell to fit the text, so is faster for tables
+                with a known width. Defaults to None, which sizes automatically.
 
         Raises:
             ValueError: If any values are missing or invalid.
@@ -81,40 +129,66 @@ class Visualise:
 
         """
         try:
-            fig, ax = plt.subplots(figsize=figsize)
+            fig, ax = get_figure(figsize, self.reuse_figure)
             # Takes axis off to only show the table
             ax.axis("off")
-            table_data = self.data.fillna(
-                fill_na).values if fill_na else self.data.values
+            # Table dimensions used throughout the styling below
+            n_rows, n_cols = self.data.shape
+            # Only copies the data to fill missing values when there are any
+            if fill_na and self.data.isna().values.any():
+                table_data = self.data.fillna(fill_na).values
+            else:
+                table_data = self.data.values
 
             table = ax.table(cellText=table_data,
                              colLabels=self.data.columns,
                              loc="center",
                              cellLoc="center",
-                             colColours=[[0.9, 0.93, 0.95, 1]] * self.data.shape[1])
+                             colColours=[[0.9, 0.93, 0.95, 1]] * n_cols)
+            # Cell dictionary keyed by (row, col) for direct cell access
+            celld = table.get_celld()
 
             table.scale(1, 1.5)
-            table.auto_set_font_size(True)
+            if fontsize:
+                table.auto_set_font_size(False)
+                table.set_fontsize(fontsize)
+            else:
+                table.auto_set_font_size(True)
 
             # Details for the size and placement for a custom note
             if note:
                 ax.text(0.8, 0.25, f"Note: {note}", fontsize=9)
 
+            # Cell keys grouped by column (body only) and by row for the colour
+            # passes
+            col_keys = {col: [] for col in range(n_cols)}
+            row_keys = {row: [] for row in range(n_rows + 1)}
+
+            # Styles are collected per cell key and applied once at the end, so
+            # later rules overwrite earlier ones without restyling the cell
+            face_colors = {}
+            text_props = {}
+
             # Customises the header row to make it stand out
-            for (row, col), cell in table.get_celld().items():
+            for (row, col), cell in celld.items():
+                row_keys[row].append((row, col))
+                cell.set_edgecolor("lightgrey")
                 if row == 0:  # Header row
                     # Bold font with dark blue text
-                    cell.set_text_props(weight="bold", color="#004085")
-                    cell.set_facecolor("#cce5ff")
-                    cell.set_edgecolor("lightgrey")
+                    text_props[(row, col)] = {"weight": "bold",
+                                              "color": "#004085"}
+                    face_colors[(row, col)] = "#cce5ff"
                 else:
-                    cell.set_edgecolor("lightgrey")
+                    col_keys[col].append((row, col))
 
             # checking if the conditions argument is a list
             if conditions and not isinstance(conditions, list):
                 raise ValueError("Conditions must be a list of dictionaries")
 
             if conditions:
+                # Column arrays so each condition is a single NumPy comparison,
+                # taken once from the frame rather than through .iloc per column
+                col_values = [values.to_numpy() for _, values in self.data.items()]
                 # Goes through all the conditions in the list[dict]
                 for condition in conditions:
                     # Defaults to no columns if no column is provided
@@ -125,34 +199,38 @@ class Visualise:
                     # Defaults to white if no color is provided
                     color = condition.get("color", "white")
 
-                    # Goes through each row to apply the conditions
-                    for row_id in range(len(self.data)):
-                        # List of values for each row
-                        row_values = self.data.iloc[row_id, :].values
-                        for col_id in columns:
-                            # Passes through every row value and applies condition
-                            if condition_func(row_values[col_id], *row_values):
-                                table[(row_id + 1, col_id)
-                                      ].set_facecolor(color)
+                    for col_id in columns:
+                        # Evaluates the condition over the whole column at once
+                        mask = np.broadcast_to(
+                            np.asarray(condition_func(col_values[col_id],
+                                                      *col_values), dtype=bool),
+                            n_rows)
+                        # Only colours the rows where the condition is met
+                        for row_id in (np.flatnonzero(mask) + 1).tolist():
+                            face_colors[(row_id, col_id)] = color
 
             # Checks if col_color is a list of dictionaries
             if col_color and isinstance(col_color, list) \
                     and all(isinstance(item, dict) for item in col_color):
                 for col_dict in col_color:  # Goes through each dictionary
                     for col_id, color in col_dict.items():
-                        for row_id in range(len(self.data)):
-                            table[(row_id + 1, col_id)].set_facecolor(color)
+                        for key in col_keys[col_id]:
+                            face_colors[key] = color
 
             # Checks if row_color is a list of dictionaries
             if row_color and isinstance(row_color, list) \
                     and all(isinstance(item, dict) for item in row_color):
                 for row_dict in row_color:  # Goes through each dictionary
                     for row_id, color in row_dict.items():
-                        for col_id in range(len(self.data.columns)):
-                            table[(row_id, col_id)].set_facecolor(
-                                color)
-                            table[(row_id, col_id)].set_text_props(
-                                weight="bold")
+                        for key in row_keys[row_id]:
+                            face_colors[key] = color
+                            text_props.setdefault(key, {})["weight"] = "bold"
+
+            # Applies the final style of each cell in a single pass
+            for key, color in face_colors.items():
+                celld[key].set_facecolor(color)
+            for key, props in text_props.items():
+                celld[key].set_text_props(**props)
 
             if title:
                 ax.set_title(title, weight="bold", fontsize=14)
@@ -200,14 +278,14 @@ class Visualise:
 
         """
         try:
-            plt.style.use("seaborn-v0_8-colorblind")
             # Doesnt plot the figure if it is for a subplot
-            fig, ax = plt.subplots(
-                figsize=figsize) if ax is None else (None, ax)
+            fig, ax = (get_figure(figsize, self.reuse_figure) if ax is None
+                       else (None, ax))
 
-            x = self.data[x_value]
-            y1 = self.data[y1_value]
-            y2 = self.data[y2_value] if y2_value else None
+            # NumPy arrays so the limits below are plain array reductions
+            x = self.data[x_value].to_numpy()
+            y1 = self.data[y1_value].to_numpy()
+            y2 = self.data[y2_value].to_numpy() if y2_value else None
 
             # Creates an array of integers for bar placement on the x-axis
             x_position = np.arange(len(x))
@@ -238,7 +316,7 @@ class Visualise:
                 ymin = y1.min() * 0.95
                 ymax = y1.max() * 1.05
 
-                ax.bar(x_position, y1, bar_width, label=y1)
+                ax.bar(x_position, y1, bar_width, label=y1_label)
 
                 ax.set_xticks(x_position)
                 ax.set_xticklabels(x, rotation=60, fontsize=10)
@@ -286,47 +364,47 @@ class Visualise:
                 Defaults to None.
             jitter (float): Amount of movement to add to points to reduce
                 overlap. Must be between 0 and 1. Defaults to 0.001.
+            ax (Matplotlib.axes, optional): A Matplotlib axes object for
+                embedding the graph into a subplot, if needed. Defaults to None.
+            figsize (tuple, optional): Size of the figure (width, height).
+                Defaults to (14, 6)
         """
         try:
-            plt.style.use("seaborn-v0_8-colorblind")
             # Doesnt plot the figure if it is for a subplot
-            fig, ax = plt.subplots(
-                figsize=figsize) if ax is None else (None, ax)
+            fig, ax = (get_figure(figsize, self.reuse_figure) if ax is None
+                       else (None, ax))
+
+            x_values = self.data[x_value].to_numpy()
+            # Jitters the y_axis for better seperation, drawn once for all rows
+            jitter_y = self.data[y_value].to_numpy() + \
+                np.random.uniform(-jitter, jitter, size=len(self.data))
 
             if group_name:
+                # Row positions of each case in the group
+                groups = self.data.groupby(group_name, sort=False).indices
                 # Plots individual lines for each case in the group
                 for member in self.data[group_name].unique():
-                    member_data = self.data[self.data[group_name] == member]
-
-                    y_values = member_data[y_value].values
-                    # Jitters the y_axis for better seperation
-                    jitter_y = y_values + \
-                        np.random.uniform(-jitter, jitter,
-                                          size=len(member_data))
+                    member_idx = groups[member]
                     # Plots the new jittered y-values
-                    plt.plot(
-                        member_data[x_value],
-                        jitter_y,
+                    ax.plot(
+                        x_values[member_idx],
+                        jitter_y[member_idx],
                         label=member,
                         marker="o"
                     )
-                    plt.legend(title=group_name, fontsize=12)
+                ax.legend(title=group_name, fontsize=12)
             else:
-                # Jitters the y_axis for better seperation
-                jitter_y = self.data[y_value] + \
-                    np.random.uniform(-jitter, jitter, size=len(self.data))
                 # Plots the new jittered y-values
-                plt.plot(self.data[x_value], jitter_y,
-                         marker="o")
+                ax.plot(x_values, jitter_y, marker="o")
 
             if title:
-                plt.title(title, weight="bold", fontsize=16)
+                ax.set_title(title, weight="bold", fontsize=16)
 
             if x_label:
-                plt.xlabel(x_label, fontsize=14)
+                ax.set_xlabel(x_label, fontsize=14)
 
             if y_label:
-                plt.ylabel(y_label, fontsize=14)
+                ax.set_ylabel(y_label, fontsize=14)
 
             # Dynamic limits for x and y-axis
             x_min = self.data[x_value].min()
@@ -335,9 +413,10 @@ class Visualise:
             y_min = (self.data[y_value]).min() * 0.95
             y_max = (self.data[y_value]).max() * 1.05
 
-            plt.xticks(np.arange(int(x_min), int(x_max) + 1), rotation=45)
-            plt.ylim(y_min, y_max)
-            plt.grid(False)
+            ax.set_xticks(np.arange(int(x_min), int(x_max) + 1))
+            ax.tick_params(axis="x", labelrotation=45)
+            ax.set_ylim(y_min, y_max)
+            ax.grid(False)
 
             # Displays figure if no axis is given
             if fig:
@@ -364,15 +443,15 @@ class Visualise:
             ax (Matplotlib.axes, optional): A Matplotlib axes object for
                 embedding the table into a subplot, if needed. Defaults to None.
         """
-        plt.style.use("seaborn-v0_8-colorblind")
-        fig, ax = plt.subplots(figsize=figsize) if ax is None else (None, ax)
+        fig, ax = (get_figure(figsize, self.reuse_figure) if ax is None
+                   else (None, ax))
 
         ax.pie(x=self.data[values], labels=self.data[labels])
 
         if title:
             ax.set_title(title, weight="bold", fontsize=16)
 
-        plt.grid(False)
+        ax.grid(False)
 
         # Displays figure if no axis is given
         if fig:
@@ -387,12 +466,49 @@ def valid_artist():
     Returns:
         str: A valid artist chosen by the user.
     """
-    artist = str(input("Enter an artist you would like to analyse\n")).strip()
-    if artist:
-        return artist
+    # Loops until a non-empty artist has been inputted
+    while True:
+        artist = input("Enter an artist you would like to analyse\n").strip()
+        if artist:
+            return artist
+
+        print("String cannot be empty. Please try again")
 
-    print("String cannot be empty. Please try again")
-    return valid_artist()
+
+@lru_cache(maxsize=1)
+def fetch_overall_popularity(db, version):
+    """
+    Fetches the average popularity of every genre from the SQLite database.
+    The result does not depend on the artist, so it is cached and only
+    re-queried when the database changes.
+
+    Args:
+        db (str): SQLite database filepath with song data.
+        version (tuple): The database's 'db_version', used as part of the
+            cache key.
+
+    Returns:
+        Pandas.DataFrame: Dataframe of 'Genre' and 'Overall Popularity' ordered
+            by ascending popularity. Shared between calls so it must not be
+            modified in place.
+    """
+    overall_query = """
+        SELECT
+            g.Genre,
+            AVG(s.Popularity) AS Overall_Popularity
+        FROM Song s
+        JOIN Artist a ON s.ArtistID = a.ID
+        JOIN Song_genre sg ON s.ID = sg.SongID
+        JOIN Genre g ON sg.GenreID = g.ID
+        GROUP BY g.Genre
+        ORDER BY Overall_Popularity ASC;
+        """
+    db = get_manager(db, read_only=True)
+    # Reads the rows straight into typed columns
+    return pd.read_sql_query(
+        overall_query, db.connection,
+        dtype={"Overall_Popularity": "float64"}
+    ).rename(columns={"Overall_Popularity": "Overall Popularity"})
 
 
 def fetch_artist_data(db, artist):
@@ -406,55 +522,58 @@ def fetch_artist_data(db, artist):
 
     Returns:
         Pandas.DataFrame: A neat dataframe containing genres, artist popularity, and
-            overall popularity from the chosen artist
+            overall popularity from the chosen artist, or None if the artist
+            has no songs in the database.
 
     Raises:
         Exception: If any unexpected errors occur while executing any functions.
     """
-    # Using DatabaseManager class
-    db = dbm(db)
+    db_path = db
+    # Shared read-only DatabaseManager, kept open across lookups
+    db = get_manager(db, read_only=True)
     # Converts artist name to a standard format for ease of searching
     artist = artist.lower().replace(" ", "")
-    # Checks database to see if the name exists
-    if db.check_db(value=artist, table="Artist", column="ArtistName"):
-        try:
-            sql_query = """
-                SELECT
-                    g.Genre,
-                    AVG(CASE
-                            WHEN LOWER(REPLACE(a.ArtistName, " ", "")) LIKE ?
-                            THEN s.Popularity
-                            ELSE NULL
-                        END) AS Artist_Popularity,
-                    AVG(s.Popularity) AS Overall_Popularity
-                FROM Song s
-                JOIN Artist a ON s.ArtistID = a.ID
-                JOIN Song_genre sg ON s.ID = sg.SongID
-                JOIN Genre g ON sg.GenreID = g.ID
-                GROUP BY g.Genre
-                ORDER BY Overall_Popularity ASC;
-                """
-
-            results = db.query(sql_query, params=(artist,))
-
-            # Tidies the dataframe to make visualisation easier
-            df = pd.DataFrame(results, columns=["Genre",
-                                                "Artist Popularity",
-                                                "Overall Popularity"])
-            df["Genre"] = df["Genre"].str.title()
-            # Replaces NAs with 0 and rounding to 2 d.p.
-            df = df.fillna(0).round(2)
-
-            return df
-
-        except Exception as e:
-            raise Exception(f"An unexpected error has occurred: {e}")
-
-        finally:
-            # Closing database connection
-            db.close()
-    else:
-        print(f"{artist} cannot be found in the database.")
+    try:
+        # Only joins the selected artist's songs to their genres
+        artist_query = """
+            SELECT
+                g.Genre,
+                AVG(s.Popularity) AS Artist_Popularity
+            FROM Song s
+            JOIN Artist a ON s.ArtistID = a.ID
+            JOIN Song_genre sg ON s.ID = sg.SongID
+            JOIN Genre g ON sg.GenreID = g.ID
+            WHERE a.ArtistNameNorm = ?
+            GROUP BY g.Genre;
+            """
+
+        # Reads the rows straight into typed columns
+        artist_df = pd.read_sql_query(
+            artist_query, db.connection, params=(artist,),
+            dtype={"Artist_Popularity": "float64"}
+        ).rename(columns={"Artist_Popularity": "Artist Popularity"})
+
+        # No rows means the name does not exist in the database
+        if artist_df.empty:
+            print(f"{artist} cannot be found in the database.")
+            return None
+
+        # Cached until the database is modified
+        overall_df = fetch_overall_popularity(db_path, db_version(db_path))
+
+        # Tidies the dataframe to make visualisation easier, keeping every
+        # genre in order of overall popularity
+        df = pd.merge(artist_df, overall_df, on="Genre", how="right")
+        df["Genre"] = df["Genre"].str.title()
+        # Replaces NAs with 0 and rounding to 2 d.p.
+        df = df.fillna(0).round(2)
+        # Genres repeat across lookups so are stored as categories
+        df["Genre"] = df["Genre"].astype("category")
+
+        return df
+
+    except Exception as e:
+        raise Exception(f"An unexpected error has occurred: {e}")
 
 
 def format_table(df, artist):
@@ -486,7 +605,7 @@ def format_table(df, artist):
     col_color = [{0: "#f2f2f2"}]
 
     Visualise(df).create_table(
-        conditions=conditions, col_color=col_color,
+        conditions=conditions, col_color=col_color, fontsize=10,
         title=f"{artist.title()} Popularity vs Overall Popularity")
 
 
@@ -517,7 +636,7 @@ def main():
 
     df = fetch_artist_data(db, artist)
 
-    if df.empty:
+    if df is None or df.empty:
         raise ValueError(f"No data has been found for {artist}.")
 
     format_table(df, artist)
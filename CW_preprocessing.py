@@ -1,6 +1,18 @@
+import atexit
+import os
 import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
 import pandas as pd
 
+# Uses PyArrow's multi-threaded CSV parser when it is installed
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
 """
 This program is designed to interact with an SQLite database and perform data preprocessing 
 for song-related datasets. It imports data from a .csv file, cleans and filters the data, 
@@ -16,6 +28,17 @@ Key Features:
     - Checks if a value exists in the database.
 """
 
+# Lets sqlite3 bind NumPy scalars taken directly from DataFrame columns
+sqlite3.register_adapter(np.bool_, int)
+sqlite3.register_adapter(np.int16, int)
+sqlite3.register_adapter(np.int32, int)
+sqlite3.register_adapter(np.int64, int)
+
+
+# Shared managers opened by 'get_manager', keyed by absolute path and whether
+# they are read-only, each stored with the device and inode of its file
+MANAGERS = {}
+
 
 # Creating a class to deal with database interactions
 class DataBaseManager:
@@ -23,16 +46,53 @@ class DataBaseManager:
     A class for managing interactions with an SQLite database.
     """
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, read_only=False):
         """
-        Establishes connection and cursor to the SQLite database.
+        Establishes connection and cursor to the SQLite database, using
+        write-ahead logging with a larger in-memory page cache and memory-mapped
+        reads. Transactions are opened explicitly rather than implicitly before
+        each statement.
 
         Attributes:
+            db_name (str): Filepath of the database.
+            read_only (bool): Whether the database is opened read-only, e.g. for
+                analysis queries. Defaults to False.
             connection (sqlite3.Connection): Connection for the database.
             cursor (sqlite.Cursor): Cursor to execute SQL queries.
+            check_queries (dict): 'check_db' queries for each searchable
+                table and column, keyed by (table, column).
         """
-        self.connection = sqlite3.connect(db_name)
+        self.db_name = db_name
+        self.read_only = read_only
+        # A read-only database is opened by URI so SQLite rejects any writes
+        if read_only:
+            database = f"{Path(db_name).resolve().as_uri()}?mode=ro"
+        else:
+            database = db_name
+        # A larger statement cache keeps repeated queries prepared
+        self.connection = sqlite3.connect(database, isolation_level=None,
+                                          cached_statements=256,
+                                          uri=read_only)
         self.cursor = self.connection.cursor()
+        # Only these tables and columns can be searched, so 'check_db' never
+        # builds SQL from its arguments
+        self.check_queries = {
+            ("Artist", "ArtistName"):
+                "SELECT 1 FROM Artist WHERE ArtistNameNorm = ? LIMIT 1",
+            ("Genre", "Genre"):
+                "SELECT 1 FROM Genre WHERE GenreNorm = ? LIMIT 1",
+            ("Song", "Song"):
+                "SELECT 1 FROM Song WHERE SongNorm = ? LIMIT 1",
+        }
+
+        # Tuning applied once per connection, the journal settings only apply
+        # when writing
+        if not read_only:
+            self.cursor.execute("PRAGMA journal_mode=WAL;")
+            self.cursor.execute("PRAGMA synchronous=NORMAL;")
+        self.cursor.execute("PRAGMA temp_store=MEMORY;")
+        self.cursor.execute("PRAGMA cache_size=-65536;")
+        self.cursor.execute("PRAGMA mmap_size=268435456;")
 
     def create_table(self, query):
         """
@@ -46,13 +106,32 @@ class DataBaseManager:
             sqlite3.Error: If there is an issue connecting or interacting with the database.
         """
         try:
+            # Commits straight away unless inside an open transaction
             self.cursor.execute(query)
-            self.connection.commit()
             print(f"Table created successfully.")
 
         except sqlite3.Error as e:
             print(f"Error creating table: {e}")
 
+    def create_index(self, query):
+        """
+        Creates an index in the SQLite3 database.
+
+        Args:
+            query (str): Query to create the index using standard SQL syntax.
+                e.g. 'CREATE INDEX index_name ON table_name (column1, ...);'
+
+        Raises:
+            sqlite3.Error: If there is an issue connecting or interacting with the database.
+        """
+        try:
+            # Commits straight away unless inside an open transaction
+            self.cursor.execute(query)
+            print(f"Index created successfully.")
+
+        except sqlite3.Error as e:
+            print(f"Error creating index: {e}")
+
     def insert_data(self, query, data):
         """
         Used to insert data into SQL database.
@@ -64,18 +143,62 @@ class DataBaseManager:
             data (list): Data to be transferred into the database.
 
         Raises:
-            ValueError: If table name does not exist in the database.
-            sqlite3.Error: If there is an issue connecting or interacting with the database.
+            ValueError: If table name does not exist in the database, when
+                inserting inside an open transaction.
+            sqlite3.Error: If there is an issue connecting or interacting with
+                the database, when inserting inside an open transaction.
         """
+        # Inside an open transaction, errors are left for that transaction to
+        # roll back so the whole block is aborted
+        joined = self.connection.in_transaction
+
         try:
-            self.cursor.executemany(query, data)
-            self.connection.commit()
+            # Joins the open transaction, or inserts the batch in its own
+            with self.transaction():
+                self.cursor.executemany(query, data)
 
         except ValueError as e:
+            if joined:
+                raise
+            self.rollback()
             print(f"Table name does not exist in database: {e}")
         except sqlite3.Error as e:
+            if joined:
+                raise
+            self.rollback()
             print(f"Error connecting or interacting with database: {e}")
 
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements inside the block as a single transaction, committing
+        at the end or rolling back if an error is raised. Blocks opened while a
+        transaction is already running join that transaction.
+
+        Raises:
+            sqlite3.Error: If there is an issue connecting or interacting with the database.
+        """
+        if self.connection.in_transaction:
+            yield
+            return
+
+        self.cursor.execute("BEGIN;")
+        try:
+            yield
+        except Exception:
+            self.rollback()
+            raise
+        # A failed statement inside the block may already have rolled back
+        if self.connection.in_transaction:
+            self.cursor.execute("COMMIT;")
+
+    def rollback(self):
+        """
+        Rolls back the open transaction, if there is one.
+        """
+        if self.connection.in_transaction:
+            self.connection.rollback()
+
     def query(self, query, params=None):
         """
         Communicates with the database for general SQL querying.
@@ -89,40 +212,52 @@ class DataBaseManager:
             tuple: A list or empty list of data collected from the database.
 
         """
-        if params:
-            return self.cursor.execute(query, params).fetchall()
-        return self.cursor.execute(query).fetchall()
+        return self.cursor.execute(query, params or ()).fetchall()
+
+    def execute(self, query, params=None):
+        """
+        Runs a single SQL statement that returns no rows, e.g. 'INSERT ... SELECT'
+        or 'DROP TABLE'. Errors are raised so an open transaction can roll back.
+
+        Args:
+            query (str): SQL statement using standard SQL syntax.
+            params (tuple, optional): Parameters bound to the statement. Defaults
+                to None for no parameters.
+
+        Raises:
+            sqlite3.Error: If there is an issue connecting or interacting with the database.
+        """
+        self.cursor.execute(query, params or ())
 
     def check_db(self, value, table, column):
         """
-        Searches database for the existance of an object in the database.
+        Searches database for the existance of an object in the database, using
+        the column's indexed normalised copy ('<column>Norm'), which holds the
+        value in lower case without spaces.
 
         Args:
             table (str): The table in the database to search.
-            column (str): The column of the table to search.
+            column (str): The column of the table to search. Must have a
+                normalised copy, e.g. 'ArtistName', 'Genre', or 'Song'.
             value (str): The value to search for.
 
         Returns:
             bool: True if value is found, false if not.
 
         Raises:
+            ValueError: If the table and column are not searchable.
             sqlite3.Error: If an error occurrs connecting to the database or 
                 query execution
         """
         if isinstance(value, str):
             value = value.replace(" ", "").lower()
 
-        if not table.isidentifier() or not column.isidentifier():
-            raise ("Invalid table or column name")
-
-        query = f"""
-        SELECT COUNT(*)
-        FROM {table}
-        WHERE LOWER(REPLACE({column}, " ", "")) LIKE ?
-        """
-        result = self.cursor.execute(query, (value,)).fetchone()
+        try:
+            query = self.check_queries[(table, column)]
+        except KeyError:
+            raise ValueError(f"Invalid table or column name: {table}.{column}")
 
-        return result[0] > 0
+        return self.cursor.execute(query, (value,)).fetchone() is not None
 
     def close(self):
         """
@@ -131,12 +266,78 @@ class DataBaseManager:
         self.connection.close()
 
 
-def import_data(file_path):
+def get_manager(db_name, read_only=False):
+    """
+    Returns a shared DataBaseManager for the database, opening it on first use.
+    The connection is kept open for later calls and closed when the program exits.
+    If the file has since been replaced, e.g. the database was rebuilt, the old
+    connection is closed and the new file is opened.
+
+    Args:
+        db_name (str): SQLite database filepath.
+        read_only (bool, optional): Whether to share a read-only connection
+            instead. Defaults to False.
+
+    Returns:
+        DataBaseManager: Open manager for the database.
+    """
+    key = (os.path.abspath(db_name), read_only)
+    try:
+        stat = os.stat(db_name)
+        identity = (stat.st_dev, stat.st_ino)
+    except FileNotFoundError:
+        identity = None
+
+    shared = MANAGERS.get(key)
+    if shared is not None:
+        if shared[1] == identity:
+            return shared[0]
+        # The path now points at a different file
+        shared[0].close()
+
+    db = DataBaseManager(db_name, read_only=read_only)
+    atexit.register(db.close)
+    stat = os.stat(db_name)
+    MANAGERS[key] = (db, (stat.st_dev, stat.st_ino))
+    return db
+
+
+def db_version(db_name):
+    """
+    Gives a value that changes whenever the database's contents may have
+    changed, for use in cache keys. Committed writes in WAL mode stay in the
+    '-wal' file until a checkpoint, so that file is checked as well as the
+    database file itself.
+
+    Args:
+        db_name (str): SQLite database filepath.
+
+    Returns:
+        tuple: Device, inode, modification time, and size of the database
+            file, followed by the modification time and size of its '-wal'
+            file (None if there is none).
+    """
+    stat = os.stat(db_name)
+    try:
+        wal = os.stat(f"{db_name}-wal")
+        wal_version = (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        wal_version = (None, None)
+
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size,
+            *wal_version)
+
+
+def import_data(file_path, columns=None, dtypes=None):
     """
     Imports and cleans data from a .csv file.
 
     Args:
         file_path (str): Location of the CSV file.
+        columns (list, optional): Names of the columns to read; any others are
+            skipped while parsing. Defaults to None for every column.
+        dtypes (dict, optional): Column names paired with the dtype to parse
+            them as. Defaults to None to infer the dtypes.
 
     Returns:
         Pandas.DataFrame: Data from the .csv file.
@@ -147,7 +348,8 @@ def import_data(file_path):
     """
     try:
         if file_path.endswith(".csv"):
-            dfSongs = pd.read_csv(file_path)
+            dfSongs = pd.read_csv(file_path, usecols=columns, dtype=dtypes,
+                                  engine=CSV_ENGINE)
             return dfSongs
 
     except ValueError:
@@ -172,21 +374,58 @@ def clean_data(data):
     try:
         # Renaming columns to meet specification
         data.rename(columns={"duration_ms": "duration"}, inplace=True)
-        data["duration"] = (data["duration"] / 1000).round()
-
-        # Cleaning data based on criteria
-        data = data[
-            (data["popularity"] > 50)
-            & (data["speechiness"] > 0.33)
-            & (data["speechiness"] < 0.66)
-            & (data["danceability"] > 0.2)
-        ]
+        data["duration"] = np.rint(data["duration"].to_numpy() / 1000)
+
+        # Cleaning data based on criteria, as one mask over the raw arrays
+        popularity = data["popularity"].to_numpy()
+        speechiness = data["speechiness"].to_numpy()
+        danceability = data["danceability"].to_numpy()
+        mask = ((popularity > 50)
+                & (speechiness > 0.33)
+                & (speechiness < 0.66)
+                & (danceability > 0.2))
+
+        # Narrowest integer types for the columns stored as integers
+        data = data[mask].astype({"duration": "int32",
+                                  "year": "int16",
+                                  "popularity": "int32",
+                                  "explicit": "bool"})
         return data
 
     except KeyError as e:
         raise KeyError(f"KeyError: Column name does not exist: {e}")
 
 
+def split_values(data, column):
+    """
+    Splits a comma-separated column so that each value gets its own row, with
+    surrounding whitespace removed. Only rows containing a comma are split, as
+    most rows hold a single value.
+
+    Args:
+        data (Pandas.DataFrame): Dataset containing the column.
+        column (str): Name of the comma-separated column.
+
+    Returns:
+        Pandas.DataFrame: The dataset with one row per value in the column, in
+            the original row order.
+    """
+    data = data.reset_index(drop=True)
+    has_comma = data[column].str.contains(",", regex=False, na=False)
+
+    if has_comma.any():
+        multi = data[has_comma]
+        multi = multi.assign(
+            **{column: multi[column].str.split(",")}).explode(column)
+        # Stable sort on the original positions restores the row order
+        split = pd.concat([data[~has_comma], multi]).sort_index(kind="stable")
+    else:
+        split = data.copy()
+
+    split[column] = split[column].str.strip()
+    return split
+
+
 def extract_data(data):
     """
     Prepares data to be inserted into database based on specification.
@@ -195,15 +434,18 @@ def extract_data(data):
         data (pd.DataFrame): Cleaned dataset.
 
     Returns:
-        lists: lists for songs, genre, artist, and song_genre relational tables.
+        tuple: Song rows as an iterator, and lists for the genre, artist, and
+            song_genre relational tables.
 
     Raises:
         KeyError: If column name does not match dataset
     """
     # Selecting columns based on crtieria
     try:
-        songs_data = data[
-            [
+        # Row tuples zipped from each column's own array, keeping their dtypes
+        songs_data = zip(*(
+            data[column].to_numpy()
+            for column in [
                 "song",
                 "duration",
                 "explicit",
@@ -213,36 +455,44 @@ def extract_data(data):
                 "speechiness",
                 "artist",
             ]
-        ].values.tolist()
+        ))
+
+        # One row per song and genre, shared by the genre and song-genre lists
+        song_genres = split_values(data[["song", "genre"]], "genre")
+        song_genres["song"] = song_genres["song"].str.strip()
 
         # Creating a list of unique genres from the dataset
-        genre_data = (
-            data["genre"].str.split(
-                ",").explode().str.strip().unique().tolist()
-        )
-        genre_data = [(genre,) for genre in genre_data]
+        genre_data = [(genre,) for genre in song_genres["genre"].unique()]
 
         # Creating a list of unique artists from the dataset
-        artist_data = (
-            data["artist"].str.split(
-                ",").explode().str.strip().unique().tolist()
-        )
-        artist_data = [(artist,) for artist in artist_data]
+        artists = split_values(data[["artist"]], "artist")
+        artist_data = [(artist,) for artist in artists["artist"].unique()]
 
         # Creating unique song-genre mappings
-        song_genre_data = list(
-            set(
-                (genre.strip(), song.strip())
-                for song, genres in data[["song", "genre"]].values
-                for genre in genres.split(",")
-            )
-        )
+        song_genre_data = list(song_genres[["genre", "song"]].drop_duplicates()
+                               .itertuples(index=False, name=None))
         return songs_data, genre_data, artist_data, song_genre_data
 
     except KeyError as e:
         raise KeyError(f"KeyError: Column name does not exist: {e}")
 
 
+def resolve_artist_ids(songs_data, artist_map):
+    """
+    Replaces the artist name at the end of each song row with the artist's ID.
+
+    Args:
+        songs_data (iterable): Song rows ending with the artist name, as
+            returned by 'extract_data'.
+        artist_map (dict): Artist names mapped to their IDs in the database.
+
+    Returns:
+        generator: Song rows ending with the artist ID, or None where the name
+            is not an artist in the database, produced as they are inserted.
+    """
+    return ((*row[:-1], artist_map.get(row[-1])) for row in songs_data)
+
+
 def main(file_path="songs.csv"):
     """
     Main function which orchestrates the process.
@@ -251,8 +501,13 @@ def main(file_path="songs.csv"):
         filepath (str): Location of .csv dataset. Defaults to songs.csv file.
     """
 
+    # Only the columns needed for cleaning and the database are read
+    columns = ["artist", "song", "duration_ms", "explicit", "year",
+               "popularity", "danceability", "speechiness", "genre"]
+    dtypes = {"explicit": "bool", "year": "int16", "popularity": "int32"}
+
     # Retrieving and cleaning data
-    dfSongs = import_data(file_path)
+    dfSongs = import_data(file_path, columns=columns, dtypes=dtypes)
     dfSongs = clean_data(dfSongs)
 
     # Extracting data ready for insertion
@@ -272,19 +527,25 @@ def main(file_path="songs.csv"):
         Danceability FLOAT, 
         Speechiness FLOAT,
         ArtistID INTEGER,
+        SongNorm TEXT GENERATED ALWAYS AS
+            (LOWER(REPLACE(Song, ' ', ''))) VIRTUAL,
         FOREIGN KEY (ArtistID) REFERENCES Artist(ID)
         );
     """,
         "Genre": """
     CREATE TABLE Genre (
         ID INTEGER PRIMARY KEY,
-        Genre VARCHAR(20)
+        Genre VARCHAR(20),
+        GenreNorm TEXT GENERATED ALWAYS AS
+            (LOWER(REPLACE(Genre, ' ', ''))) VIRTUAL
         );
     """,
         "Artist": """
     CREATE TABLE Artist ( 
         ID INTEGER PRIMARY KEY, 
-        ArtistName VARCHAR(20)
+        ArtistName VARCHAR(20),
+        ArtistNameNorm TEXT GENERATED ALWAYS AS
+            (LOWER(REPLACE(ArtistName, ' ', ''))) VIRTUAL
         );
     """,
         "Song_genre": """
@@ -303,8 +564,8 @@ def main(file_path="songs.csv"):
         print(f"Creating table: {table_name}")
         db.create_table(query)
 
-    # Data insertion queries as a dictionary
-    data_queries = {
+    # Lookup table insertion queries as a dictionary
+    lookup_queries = {
         "Genre": (
             """
         INSERT INTO Genre (Genre)
@@ -319,29 +580,107 @@ def main(file_path="songs.csv"):
         """,
             artist_data,
         ),
-        "Song": (
-            """
+    }
+
+    # Inserting all of the data as one transaction
+    with db.transaction():
+        for table_name, (insert_query, data) in lookup_queries.items():
+            db.insert_data(insert_query, data)
+
+        # Indexes on the names looked up by the song-genre insert, built once
+        # the lookup tables are filled
+        lookup_index_queries = {
+            "ix_artist_name": """
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_artist_name ON Artist(ArtistName);
+        """,
+            "ix_genre_name": """
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_genre_name ON Genre(Genre);
+        """,
+        }
+        for index_name, query in lookup_index_queries.items():
+            print(f"Creating index: {index_name}")
+            db.create_index(query)
+
+        # Resolving every artist ID once instead of a subquery per song
+        artist_map = dict(db.query("SELECT ArtistName, ID FROM Artist;"))
+        songs_data = resolve_artist_ids(songs_data, artist_map)
+
+        # Data insertion queries as a dictionary
+        data_queries = {
+            "Song": (
+                """
         INSERT INTO Song (
         Song, Duration, Explicit, Year, Popularity, Danceability, Speechiness, ArtistID) 
-        SELECT ?, ?, ?, ?, ?, ?, ?, (Select ID FROM Artist WHERE ArtistName = ?);
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
         """,
-            songs_data,
-        ),
-        "Song_genre": (
-            """
+                songs_data,
+            ),
+            # Song-genre pairs are staged and matched to IDs in one statement
+            "Song_genre_stage": (
+                """
+        INSERT INTO Song_genre_stage (Genre, Song)
+        VALUES (?, ?);
+        """,
+                song_genre_data,
+            ),
+        }
+
+        print("Creating table: Song_genre_stage")
+        db.create_table("""
+    CREATE TEMP TABLE Song_genre_stage (
+        Genre VARCHAR(20),
+        Song VARCHAR(50)
+        );
+    """)
+
+        # Inserting the data based on the dictionary
+        for table_name, (insert_query, data) in data_queries.items():
+            db.insert_data(insert_query, data)
+
+        print("Creating index: ix_song_name")
+        db.create_index("""
+        CREATE INDEX IF NOT EXISTS ix_song_name ON Song(Song);
+        """)
+
+        # Set-based insert of every staged pair
+        db.execute("""
         INSERT INTO Song_genre (SongID, GenreID)
         SELECT DISTINCT s.ID, g.ID
-        FROM Song s
-        JOIN Genre g ON g.Genre = ?
-        WHERE s.Song = ? 
-        """,
-            song_genre_data,
-        ),
+        FROM Song_genre_stage x
+        JOIN Song s ON s.Song = x.Song
+        JOIN Genre g ON g.Genre = x.Genre;
+        """)
+        db.execute("DROP TABLE Song_genre_stage;")
+
+    # Index creation SQL queries as a dictionary
+    index_queries = {
+        "ix_artist_norm": """
+    CREATE INDEX IF NOT EXISTS ix_artist_norm ON Artist(ArtistNameNorm);
+    """,
+        "ix_genre_norm": """
+    CREATE INDEX IF NOT EXISTS ix_genre_norm ON Genre(GenreNorm);
+    """,
+        "ix_song_norm": """
+    CREATE INDEX IF NOT EXISTS ix_song_norm ON Song(SongNorm);
+    """,
+        # Song_genre(SongID) lookups are already covered by its primary key
+        "ix_song_artist": """
+    CREATE INDEX IF NOT EXISTS ix_song_artist ON Song(ArtistID);
+    """,
+        "ix_sg_genre": """
+    CREATE INDEX IF NOT EXISTS ix_sg_genre ON Song_genre(GenreID);
+    """,
+        # Covers the per-year genre statistics so they are read from the index
+        "ix_song_year": """
+    CREATE INDEX IF NOT EXISTS ix_song_year
+    ON Song(Year, Popularity, Danceability, Duration);
+    """,
     }
 
-    # Inserting the data based on the dictionary
-    for table_name, (insert_query, data) in data_queries.items():
-        db.insert_data(insert_query, data)
+    # Creating indexes in the index dictionary
+    for index_name, query in index_queries.items():
+        print(f"Creating index: {index_name}")
+        db.create_index(query)
 
     # Closing database connection
     db.close()
@@ -1,4 +1,5 @@
-from CW_preprocessing import DataBaseManager as dbm
+from functools import lru_cache
+from CW_preprocessing import db_version, get_manager
 from Artist import Visualise
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -47,29 +48,27 @@ def valid_year():
             print("Value Error: must be an integer. Try again")
 
 
-def fetch_genre_data(db, year):
+@lru_cache(maxsize=32)
+def query_genre_data(db, version, year):
     """
-    Takes the user-chosen year and fetches average popularity, danceability, 
-    and duration from the database during the year.
+    Queries the database for the genre statistics of a year. Results are cached
+    by database, version, and year so a repeated year skips the query.
 
     Args:
-        db (str): Filepath to the SQLite3 database.
-        year (int): Year to be fetched from the database. 
+        db (DataBaseManager): Open manager for the SQLite3 database.
+        version (tuple): The database's 'db_version', used as part of the
+            cache key.
+        year (int): Year to be fetched from the database.
 
     Returns:
-        Pandas.DataFrame: Dataframe with the following columns:
-            - Genre
-            - Song Count
-            - Average Popularity
-            - Average Danceability
-            - Average Duration (s)
+        Pandas.DataFrame: Dataframe of genre statistics for the year, empty if
+            there are no songs. Shared between calls so it must not be modified
+            in place.
 
     Raises:
         Exception: If DatabaseManager encounters an error while interacting with
             the database.
     """
-    # Calling DatabaseManager class
-    db = dbm(db)
     sql_query = """
             SELECT
                 g.Genre,
@@ -89,9 +88,9 @@ def fetch_genre_data(db, year):
             ORDER BY
                 g.Genre ASC;
             """
-    # Using query function to fetch the relevent data from the database
+    # Reading the relevent data straight into a typed Pandas.DataFrame
     try:
-        results = db.query(sql_query, params=(year,))
+        df = pd.read_sql_query(sql_query, db.connection, params=(year,))
 
     except Exception as e:
         raise Exception(
@@ -104,17 +103,46 @@ def fetch_genre_data(db, year):
                "Average Danceability",
                "Average Duration (s)"]
 
-    # Converting to Pandas.DataFrame
-    df = pd.DataFrame(results, columns=columns)
+    df.columns = columns
     df["Genre"] = df["Genre"].str.title()
 
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    return df.fillna(0).round(2).sort_values("Average Duration (s)", ascending=False)
+
+
+def fetch_genre_data(db, year):
+    """
+    Takes the user-chosen year and fetches average popularity, danceability, 
+    and duration from the database during the year.
+
+    Args:
+        db (DataBaseManager): Open manager for the SQLite3 database, kept open
+            by the caller so repeated queries reuse the connection.
+        year (int): Year to be fetched from the database. 
+
+    Returns:
+        Pandas.DataFrame: Dataframe with the following columns:
+            - Genre
+            - Song Count
+            - Average Popularity
+            - Average Danceability
+            - Average Duration (s)
+
+    Raises:
+        Exception: If DatabaseManager encounters an error while interacting with
+            the database.
+    """
+    # Cached per year until the database is modified
+    df = query_genre_data(db, db_version(db.db_name), year)
+
     if df.empty:
         print(
             f"No results found for {year}. Try another year."
         )
-        return pd.DataFrame(columns=columns)
 
-    return df.fillna(0).round(2).sort_values("Average Duration (s)", ascending=False)
+    return df
 
 
 def format_table(df, year):
@@ -128,7 +156,7 @@ def format_table(df, year):
 
     # Calling Visualise class
     vs = Visualise(df)
-    vs.create_table(title=f"Genre Statistics for {year}")
+    vs.create_table(title=f"Genre Statistics for {year}", fontsize=10)
 
 
 def format_graph(df, year):
@@ -143,8 +171,6 @@ def format_graph(df, year):
     # Calling Visualise class
     vs = Visualise(df)
 
-    plt.style.use("seaborn-v0_8-colorblind")
-
     # Creating a subplot to present both graphs
     fig, axes = plt.subplots(1, 2, figsize=(14, 6))
 
@@ -174,9 +200,12 @@ def main():
     Raises:
         Exception: if any unexpected errors occur.
     """
+    # Shared read-only connection, kept open so 'query_genre_data' can reuse
+    # its cache
+    db_manager = get_manager(db, read_only=True)
     try:
         year = valid_year()
-        df = fetch_genre_data(db, year)
+        df = fetch_genre_data(db_manager, year)
 
         format_table(df, year)
         format_graph(df, year)
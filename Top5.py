@@ -1,6 +1,10 @@
+import argparse
+import hashlib
+import os
+import tempfile
 import pandas as pd
 import numpy as np
-from CW_preprocessing import DataBaseManager as dbm
+from CW_preprocessing import db_version, get_manager
 from Artist import Visualise as vsl
 
 """
@@ -26,7 +30,8 @@ Key Features:
     the top 5 artists across the year rang
 
 Usage:
-- The user will be prompted to enter a start and end year for analysis.
+- The start and end year can be given as '--start' and '--end', otherwise the
+    user will be prompted to enter a start and end year for analysis.
 - The program will fetch artist data for the specified year range from a database.
 - It will process the data to calculate penalties, rank values, and generate 
     visualizations.
@@ -34,41 +39,85 @@ Usage:
     rank value trends over time.
 """
 
+# Directory holding the cached results of 'fetch_and_process_data', keeping at
+# most 'CACHE_SIZE' of the most recently used. 'CACHE_VERSION' is raised
+# whenever the cached frames change, so older files are not read back
+CACHE_DIR = ".cache"
+CACHE_SIZE = 32
+CACHE_VERSION = 1
 
-def get_year_range():
+# Default weights for the penalty and rank value equations
+PENALTY_WEIGHTS = {"Explicit": 0.15, "Duration": 0.15}
+RANK_WEIGHTS = {"song_weight": 0.2, "pop_weight": 0.6, "dance_weight": 0.4}
+
+# Columns the penalty and rank value equations need
+PENALTY_COLUMNS = frozenset({"Explicit", "Avg Dur", "Count"})
+RANK_COLUMNS = frozenset({"Count", "Avg Pop", "Avg Dance"})
+
+
+def check_year_range(year1, year2):
     """
-    Prompts user to give a valid start and end year between 1998 and 2020.
+    Checks that a start and end year are a valid range between 1998 and 2020.
+
+    Args:
+        year1 (int): Start year for the range.
+        year2 (int): End year for the range.
 
     Returns:
         int: year1, start year for the range.
         int: year2, end year for the range.
 
     Raises:
-        ValueError: If input is not an integer.
+        ValueError: If either year is outside 1998-2020 or the years are the
+            same.
+    """
+    if not ((1998 <= year1 <= 2020) and (1998 <= year2 <= 2020)):
+        raise ValueError("Invalid year range")
+    if year1 == year2:
+        raise ValueError("Start and end year cannot be the same")
+    if year1 > year2:
+        print("Start year is larger than end year and therefore have been "
+              "swapped.")
+        return year2, year1
+    return year1, year2
+
+
+def get_year_range(year1=None, year2=None):
     """
+    Gives a valid start and end year between 1998 and 2020. Years passed in,
+    e.g. from the command line, are checked once, otherwise the user is
+    prompted until a valid range is entered.
+
+    Args:
+        year1 (int, optional): Start year for the range. Defaults to None to
+            prompt the user.
+        year2 (int, optional): End year for the range. Defaults to None to
+            prompt the user.
+
+    Returns:
+        int: year1, start year for the range.
+        int: year2, end year for the range.
+
+    Raises:
+        ValueError: If the years passed in are not a valid range.
+    """
+    if year1 is not None and year2 is not None:
+        return check_year_range(year1, year2)
+
     while True:
         try:
             year1 = int(
                 input("Enter the start year for analysis (1998-2020): "))
             year2 = int(
                 input(f"Enter the end year for analysis ({year1}-2020): "))
-
-            if (1998 <= year1 <= 2020) and (1998 <= year2 <= 2020):
-                if year1 == year2:
-                    print("Start and end year cannot be the same: Try again.")
-                elif year1 > year2:
-                    year1, year2 = year2, year1
-                    print(
-                        "Start year is larger than end year and therefore have \
-                        been swapped.")
-                    return year1, year2
-                else:
-                    return year1, year2
-            else:
-                print("Invalid year range: Try again.")
-
         except ValueError:
             print("ValueError: Input must be an integer, try again.")
+            continue
+
+        try:
+            return check_year_range(year1, year2)
+        except ValueError as e:
+            print(f"{e}: Try again.")
 
 
 def validate_weights(weights, default_weights):
@@ -89,13 +138,12 @@ def validate_weights(weights, default_weights):
             or if the weights are not between 0 and 1.
     """
     if weights:
-        # Creates a list of invalid names
-        invalid_weights = [
-            key for key in weights if key not in default_weights]
+        # Creates a set of invalid names
+        invalid_weights = set(weights).difference(default_weights)
 
         if invalid_weights:
             raise ValueError(f"Invalid weight keys: \
-                             {', '.join(invalid_weights)}")
+                             {', '.join(sorted(invalid_weights))}")
         # Checks if the weights are numbers
         if not all(isinstance(value, (float, int)) for value in weights.values()):
             raise ValueError(
@@ -116,65 +164,199 @@ def validate_columns(data, required_cols):
     Args:
         data (Pandas.DataFrame): Dataframe containing column names to be
             validated.
-        required_cols (list): List of column name strings which must be
-            present for the dataframe to be valid.
+        required_cols (iterable): Column name strings which must be present
+            for the dataframe to be valid.
 
     Raises:
         ValueError: If the dataframe is missing any required columns.
     """
-    # Creates a list of missing columns
-    missing_cols = [col for col in required_cols if col not in data.columns]
+    # Creates a set of missing columns
+    missing_cols = set(required_cols).difference(data.columns)
 
     if missing_cols:
         raise ValueError(f"Dataframe is missing the required columns: \
-                         {', '.join(missing_cols)}")
+                         {', '.join(sorted(missing_cols))}")
+
+
+def prune_cache():
+    """
+    Deletes the least recently used results in 'CACHE_DIR' so that at most
+    'CACHE_SIZE' are kept.
+    """
+    cache_files = []
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith("top5_") and name.endswith(".pkl"):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                cache_files.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                # Already pruned by another process
+                continue
+    cache_files.sort(reverse=True)
+
+    for _, path in cache_files[CACHE_SIZE:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
-def fetch_and_process_data(db, start, end):
+def validate_scores(data):
+    """
+    Checks the rank values worked out by SQLite against 'calculate_penalty' and
+    'calculate_rank', which apply the same equations in Python.
+
+    Args:
+        data (Pandas.DataFrame): Dataframe returned by 'fetch_and_process_data'.
+
+    Raises:
+        ValueError: If any artist's rank value does not match.
+    """
+    expected = calculate_rank(data, calculate_penalty(data))
+    mismatched = ~np.isclose(data["Score"].to_numpy(), expected.to_numpy())
+
+    if mismatched.any():
+        names = data.loc[mismatched, "Name"].astype(str).unique()
+        raise ValueError(f"Rank values do not match for: {', '.join(names)}")
+
+
+def fetch_and_process_data(db, start, end, validate=False):
     """
     Connects to the database and fetches data from the year range given by the
     user about popularity, danceability, duration, explicit song count, and total 
-    song count.
+    song count. Results are cached on disk in 'CACHE_DIR' and only re-queried
+    when the database, the query, its weights, or the column types change.
 
     Args:
         db (str): SQLite database filepath.
         start (int): Start of the year range to fetch the data from.
         end (int): End of the year range to fetch the data from.
+        validate (bool, optional): Whether to check the rank values against
+            'validate_scores'. Defaults to False.
 
     Returns:
         Pandas.DataFrame: Dataframe with neat titles of data from between the 
-            selected years.
+            selected years for the top 5 artists, one row per artist and year
+            ordered by name and year, including the rank value as 'Score'.
     """
-    # Connecting to the database
-    db = dbm(db)
-
+    # Penalty and rank value are worked out per artist and year by SQLite,
+    # using the same equations as 'calculate_penalty' and 'calculate_rank'.
+    # Only the rows of the 5 artists with the highest average rank value are
+    # returned
     query = """
+    WITH Yearly AS (
+        SELECT
+            a.ArtistName,
+            s.Year,
+            AVG(s.Popularity) AS Avg_Pop,
+            AVG(s.Danceability) AS Avg_Dan,
+            AVG(s.Duration) AS Avg_Dur,
+            SUM(CASE
+                    WHEN s.Explicit = 1
+                    THEN 1
+                    ELSE 0
+                END) AS Num_Expl,
+            COUNT(s.ID) AS Song_Count
+        FROM Artist a
+        JOIN Song s ON s.ArtistID = a.ID
+        WHERE s.Year >= :start AND s.Year <= :end
+        GROUP BY a.ArtistName, s.Year
+    ),
+    Scored AS (
+        SELECT
+            ArtistName,
+            Year,
+            Avg_Pop,
+            Avg_Dan,
+            Avg_Dur,
+            Num_Expl,
+            Song_Count,
+            Avg_Pop * :pop_weight
+                + (Avg_Dan * 100) * :dance_weight
+                * (1 - (Num_Expl * 1.0 / Song_Count) * :Explicit)
+                * (1 - CASE
+                        WHEN Avg_Dur < 120 OR Avg_Dur > 270
+                        THEN :Duration
+                        ELSE 0
+                    END)
+                * (1 + Song_Count * :song_weight) AS Score
+        FROM Yearly
+    ),
+    Top5 AS (
+        SELECT ArtistName
+        FROM Scored
+        GROUP BY ArtistName
+        ORDER BY AVG(Score) DESC, ArtistName
+        LIMIT 5
+    )
     SELECT
-        a.ArtistName,
+        s.ArtistName,
         s.Year,
-        AVG(s.Popularity) AS Avg_Pop,
-        AVG(s.Danceability) AS Avg_Dan,
-        AVG(s.Duration) AS Avg_Dur,
-        SUM(CASE
-                WHEN s.Explicit = 1
-                THEN 1
-                ELSE 0
-            END) AS Num_Expl,
-        COUNT(s.ID) AS Song_Count
-    FROM Artist a
-    JOIN Song s ON s.ArtistID = a.ID
-    WHERE s.Year >= ? AND s.Year <= ?
-    GROUP BY a.ArtistName
-    ORDER BY Avg_Pop DESC
+        s.Avg_Pop,
+        s.Avg_Dan,
+        s.Avg_Dur,
+        s.Num_Expl,
+        s.Song_Count,
+        s.Score
+    FROM Scored s
+    JOIN Top5 t ON t.ArtistName = s.ArtistName
+    ORDER BY s.ArtistName, s.Year
     ;
     """
-    params = (start, end)
-    artists = db.query(query, params)
+    params = {"start": start, "end": end, **PENALTY_WEIGHTS, **RANK_WEIGHTS}
+    # The averages are only inputs to the rank value, so single precision is
+    # enough, but the displayed 'Score' keeps double precision
+    dtypes = {"Year": "int16", "Avg_Pop": "float32", "Avg_Dan": "float32",
+              "Avg_Dur": "float32", "Num_Expl": "int32",
+              "Song_Count": "int32", "Score": "float64"}
+
+    # Cache key covering the database's contents, the query and everything
+    # bound to it, the column types, and the cache format
+    key = hashlib.md5(
+        f"{CACHE_VERSION}|{os.path.abspath(db)}|{db_version(db)}|"
+        f"{query}|{sorted(params.items())}|{sorted(dtypes.items())}"
+        .encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"top5_{key}.pkl")
+
+    try:
+        # Marks the file as recently used so pruning keeps it
+        os.utime(cache_path)
+        df = pd.read_pickle(cache_path)
+        if validate:
+            validate_scores(df)
+        return df
+    except FileNotFoundError:
+        pass
+
+    # Connecting to the database read-only, reusing its open connection if
+    # there is one
+    db = get_manager(db, read_only=True)
+
+    # Reads the rows straight into right-sized typed columns in one call
+    df = pd.read_sql_query(query, db.connection, params=params, dtype=dtypes)
 
     column_names = ["Name", "Year", "Avg Pop",
-                    "Avg Dance", "Avg Dur", "Explicit", "Count"]
+                    "Avg Dance", "Avg Dur", "Explicit", "Count", "Score"]
+    # read_sql_query already gives each column its own contiguous array
+    df.columns = column_names
+
+    # Written to a temporary file first so an interrupted write never leaves
+    # a partial pickle under the cache key
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix="top5_",
+                                     suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_pickle(temp_path)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    prune_cache()
 
-    return pd.DataFrame(artists, columns=column_names)
+    if validate:
+        validate_scores(df)
+    return df
 
 
 def calculate_penalty(data, weights=None):
@@ -190,21 +372,24 @@ def calculate_penalty(data, weights=None):
     Returns:
         Pandas.Series: A series containing the overall penalty for each artist.
     """
-    default_weights = {"Explicit": 0.15, "Duration": 0.15}
-    required_cols = ["Explicit", "Avg Dur", "Count"]
+    default_weights = dict(PENALTY_WEIGHTS)
 
     validate_weights(weights, default_weights)
-    validate_columns(data, required_cols=required_cols)
+    validate_columns(data, required_cols=PENALTY_COLUMNS)
+
+    explicit = data["Explicit"].to_numpy(dtype=float)
+    count = data["Count"].to_numpy(dtype=float)
+    duration = data["Avg Dur"].to_numpy(dtype=float)
 
-    # Penalty for songs that are explicit
-    explicit_pen = 1 - ((data["Explicit"] / data["Count"])
-                        * default_weights["Explicit"])
+    # Penalty for songs that are explicit, worked out in a single buffer
+    penalty = np.divide(explicit, count)
+    penalty *= -default_weights["Explicit"]
+    penalty += 1
     # Penality for songs that are too long or too short
-    duration_pen = 1 - (np.where(
-        (data["Avg Dur"] < 120) | (data["Avg Dur"] > 270),
-        default_weights["Duration"], 0))
+    penalty *= np.where((duration < 120) | (duration > 270),
+                        1 - default_weights["Duration"], 1)
     # Combined penalty - overall score will be multiplied by this number
-    return explicit_pen * duration_pen
+    return pd.Series(penalty, index=data.index)
 
 
 def calculate_rank(data, penalty, weights=None):
@@ -222,21 +407,26 @@ def calculate_rank(data, penalty, weights=None):
     Returns:
         Pandas.Series: A series of rank scores for each song
     """
-    default_weights = {"song_weight": 0.2,
-                       "pop_weight": 0.6, "dance_weight": 0.4}
-    required_cols = ["Count", "Avg Pop", "Avg Dance"]
+    default_weights = dict(RANK_WEIGHTS)
 
-    validate_columns(data, required_cols)
+    validate_columns(data, RANK_COLUMNS)
     weights = validate_weights(weights, default_weights)
 
-    song_multiplier = 1 + (data["Count"] * weights["song_weight"])
+    popularity = data["Avg Pop"].to_numpy(dtype=float)
+    danceability = data["Avg Dance"].to_numpy(dtype=float)
+    count = data["Count"].to_numpy(dtype=float)
+
+    song_multiplier = count * weights["song_weight"]
+    song_multiplier += 1
 
-    # Equation to calculate the overall rank value for each artist
-    rank = ((data["Avg Pop"] * weights["pop_weight"]) +
-            ((data["Avg Dance"] * 100) * weights["dance_weight"]) *
-            penalty * song_multiplier
-            )
-    return rank
+    # Equation to calculate the overall rank value for each artist, worked
+    # out in a single buffer
+    rank = danceability * 100
+    rank *= weights["dance_weight"]
+    rank *= np.asarray(penalty, dtype=float)
+    rank *= song_multiplier
+    rank += popularity * weights["pop_weight"]
+    return pd.Series(rank, index=data.index)
 
 
 def top5_prep(data, start, end):
@@ -246,8 +436,8 @@ def top5_prep(data, start, end):
 
     Args:
         data (Pandas.DataFrame): Dataframe containing the Name, Year, and
-            variables needed to calculate the rank value for each artist in the 
-            year range.
+            rank value ('Score') for each artist in the year range, as returned
+            by 'fetch_and_process_data'.
         start (int): Start of the year range.
         end (int): End of the year range.
 
@@ -255,36 +445,47 @@ def top5_prep(data, start, end):
         Pandas.DataFrame: Dataframe of the Top 5 artists within the year range
             based on their rank value.
     """
-    penalty = calculate_penalty(data)
-    data["Score"] = calculate_rank(data, penalty)
+    # Grouping on category codes rather than the name strings
+    data["Name"] = data["Name"].astype("category")
 
-    # Grouping by artist name and year to gather the average scores
-    average_scores = data.groupby(["Name", "Year"], as_index=False)[
-        "Score"].mean()
+    # Averaging the scores for each artist and year, then unstacking so the
+    # years are displayed as columns. Rows arrive sorted by name and year, so
+    # the keys are not sorted again
+    pivot_data = data.groupby(["Name", "Year"], sort=False, observed=True)[
+        "Score"].mean().unstack("Year")
 
-    # Pivoting data to so the years are displayed as columns
-    pivot_data = pd.pivot_table(
-        average_scores, values="Score", index="Name", columns="Year")
-
-    # List of years in case of any null values for any year
+    # List of years in case of any null values for any year, only adding
+    # columns when a year has no songs
     full_years = list(range(start, end + 1))
-    pivot_data = pivot_data.reindex(columns=full_years)
+    if list(pivot_data.columns) != full_years:
+        pivot_data = pivot_data.reindex(columns=full_years)
 
     # Mean rank value for each artist within the year range
-    pivot_data["Average"] = pivot_data.mean(skipna=True, axis=1)
-    pivot_data = pivot_data.sort_values("Average", ascending=False)
-
-    # Slicing the top 5 highest rank values
-    top5_table = pivot_data.reset_index().round(2).head(5)
-
-    # Creating an average row to calculate the mean for each year
-    average_row = top5_table.iloc[:, 1:-1].mean(axis=0, skipna=True).round(2)
-    average_row["Name"] = "Year Average"
+    averages = np.nanmean(pivot_data.to_numpy(dtype=float), axis=1)
+
+    # Picking the top 5 highest rank values without sorting every artist,
+    # then ordering just those five
+    top5_idx = np.arange(len(averages))
+    if len(averages) > 5:
+        top5_idx = np.sort(np.argpartition(-averages, 4)[:5])
+    top5_idx = top5_idx[np.argsort(-averages[top5_idx], kind="stable")]
+
+    top5_table = pivot_data.iloc[top5_idx].assign(
+        Average=averages[top5_idx]).round(2).reset_index()
+
+    # Creating an average row with the mean for each year, skipping NaNs
+    years = top5_table.iloc[:, 1:-1].to_numpy(dtype=float)
+    counts = np.count_nonzero(~np.isnan(years), axis=0)
+    year_average = np.divide(np.nansum(years, axis=0), counts,
+                             out=np.full(counts.shape, np.nan),
+                             where=counts > 0).round(2)
     # Does not show the avergae of the artist averages (bottom right cell)
-    average_row["Average"] = " "
+    average_row = ["Year Average", *year_average, " "]
 
-    top5_table = pd.concat(
-        [top5_table, average_row.to_frame().T], ignore_index=True)
+    top5_table = pd.DataFrame(
+        np.vstack([top5_table.to_numpy(dtype=object),
+                   np.array(average_row, dtype=object)]),
+        columns=top5_table.columns)
 
     return top5_table
 
@@ -302,25 +503,32 @@ def format_table(data, start, end):
     """
     conditions = []
 
-    # Getting the max values for each column
-    for col_id, col_name in enumerate(data.columns[1:-1], start=1):
-        max_value = data[col_name].max()
+    # Year columns sit between 'Name' and 'Average', which is the last column
+    year_cols = data.columns[1:-1]
+    avg_idx = len(data.columns) - 1
 
+    # Working out which cells are each year's max or NULL once, up front
+    years = data[year_cols].to_numpy(dtype=float)
+    is_nan = np.isnan(years)
+    is_max = years == np.fmax.reduce(years, axis=0)
+    is_other = ~(is_max | is_nan)
+
+    for col_id in range(1, avg_idx):
         # Displays max values as green
         conditions.append({"columns": [col_id],
-                           "condition": lambda x, *args, max_val=max_value: x == max_val,
+                           "condition": lambda x, *args, mask=is_max[:, col_id - 1]: mask,
                            "color": "#d4edda"})
         # Displays NULL values as red
         conditions.append({"columns": [col_id],
-                           "condition": lambda x, *args: np.isnan(x),
+                           "condition": lambda x, *args, mask=is_nan[:, col_id - 1]: mask,
                            "color": "#f8d7da"})
         # Displays every other cell as white
         conditions.append({"columns": [col_id],
-                           "condition": lambda x, *args, max_val=max_value: x != max_val and not np.isnan(x),
+                           "condition": lambda x, *args, mask=is_other[:, col_id - 1]: mask,
                            "color": "white"})
 
     # Grey columns for presentation
-    grey_columns = [{0: "#f2f2f2", data.columns.get_loc("Average"): "#f2f2f2"}]
+    grey_columns = [{0: "#f2f2f2", avg_idx: "#f2f2f2"}]
 
     # Visualisation class from Artist.py
     vsl(data).create_table(
@@ -343,13 +551,14 @@ def format_graph(data, start, end):
         start (int): Start of the year range.
         end (int): End of the year range.
     """
-    # Reversing the pivot so it is appripriate for visualisation
-    top5_long = data.melt(id_vars="Name",
-                          value_vars=data.columns[1:-1],
-                          var_name="Year",
-                          value_name="Rank Value")
-
-    top5_long = top5_long.fillna(0)
+    # Reversing the pivot so it is appripriate for visualisation, one year
+    # at a time, with years that have no songs plotted as 0
+    years = data.columns[1:-1]
+    rank_values = np.nan_to_num(data[years].to_numpy(dtype=float), nan=0.0)
+    top5_long = pd.DataFrame({
+        "Name": np.tile(data["Name"].to_numpy(), len(years)),
+        "Year": np.repeat(years.to_numpy(), len(data)),
+        "Rank Value": rank_values.ravel(order="F")})
 
     # Visualisation class from Artist.py
     vsl(top5_long).create_line(
@@ -362,17 +571,43 @@ def format_graph(data, start, end):
         y_label="Rank Value")
 
 
-def main():
+def main(argv=None):
     """
     Main script to orchestrate the processes.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to None to use
+            'sys.argv'.
     """
+    parser = argparse.ArgumentParser(
+        description="Top 5 artists between two years (1998-2020).")
+    parser.add_argument("--start", type=int, help="Start year for analysis.")
+    parser.add_argument("--end", type=int, help="End year for analysis.")
+    parser.add_argument("--validate", action="store_true",
+                        help="Check the rank values against the Python "
+                             "equations.")
+    args = parser.parse_args(argv)
+
+    # Years given on the command line are checked here so mistakes are
+    # reported as usage errors rather than unexpected ones
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end must be given together")
+    if args.start is not None:
+        try:
+            args.start, args.end = check_year_range(args.start, args.end)
+        except ValueError as e:
+            parser.error(f"{e}: --start and --end must be different years "
+                         "between 1998 and 2020")
+
     try:
-        start, end = get_year_range()
+        start, end = get_year_range(args.start, args.end)
 
-        df = fetch_and_process_data(db, start, end)
+        df = fetch_and_process_data(db, start, end, validate=args.validate)
 
         top5 = top5_prep(df, start, end)
 
+        # Drawn one after the other on this thread, since pyplot is not
+        # thread-safe
         format_table(top5, start, end)
         format_graph(top5, start, end)
     except Exception as e: